@@ -1,31 +1,100 @@
 # mcp_hpc_client.py
 import os
-import json
 import uuid
 import time
+import base64
+import hashlib
 import asyncio
-from upstash_redis import Redis
+import logging
+import orjson
+import zstandard as zstd
+from upstash_redis.asyncio import Redis
 from mcp.server.fastmcp import FastMCP
 
 # Init FastMCP
 mcp = FastMCP("HPC-Orchestrator")
 
-# Redis client avec upstash_redis (REST API)
+# Progression sur stderr via logging : en transport stdio, stdout porte le JSON-RPC
+logger = logging.getLogger("hpc.client")
+
+# Redis client async avec upstash_redis (REST API). Son pool httpx est lié
+# à l'event loop : un client par loop, réutilisé entre les appels de tools.
 _redis_client = None
+_redis_loop = None
 
 def get_redis():
-    global _redis_client
-    if _redis_client is None:
+    global _redis_client, _redis_loop
+    loop = asyncio.get_running_loop()
+    if _redis_client is None or _redis_loop is not loop:
         _redis_client = Redis.from_env()
+        _redis_loop = loop
     return _redis_client
 
+
+def _run_sync(coro):
+    """
+    asyncio.run() pour les shims synchrones : chaque appel a sa propre loop,
+    le client Redis créé pour elle est donc fermé avant que la loop disparaisse.
+    """
+    async def run_and_close():
+        global _redis_client, _redis_loop
+        try:
+            return await coro
+        finally:
+            if _redis_client is not None and _redis_loop is asyncio.get_running_loop():
+                client, _redis_client, _redis_loop = _redis_client, None, None
+                await client.close()
+
+    return asyncio.run(run_and_close())
+
 QUEUE_NAME = "hpc:jobs"
+HEAVY_QUEUE_NAME = "hpc:jobs:heavy"
 RESULTS_PREFIX = "hpc:result:"
+DONE_CHANNEL_PREFIX = "hpc:done:"
+LOG_PREFIX = "hpc:log:"
+QUEUE_TTL = 86400  # 24h
+INFLIGHT_PREFIX = "hpc:inflight:"
+# TTL court : le worker le prolonge tant que le job tourne, un job perdu
+# (worker mort après le RPOP) ne bloque donc les doublons qu'une minute
+INFLIGHT_TTL = 60
+INFLIGHT_CLAIM_ATTEMPTS = 3
 
+# Supprime le verrou seulement s'il porte encore notre job_id (même script
+# que le worker) : un verrou expiré puis repris par un autre client est épargné
+_RELEASE_INFLIGHT_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
 
-def submit_job(job_type: str, **params) -> str:
+# Jobs qui monopolisent GPU / disque : queue dédiée, dépilée seulement
+# quand un worker a un slot lourd libre (cf. HPCWorker.HEAVY_JOB_TYPES)
+HEAVY_JOB_TYPES = {"podman_build", "podman_run", "srun_script"}
+
+# Jobs sans effet de bord : deux soumissions identiques simultanées
+# partagent le même job (les podman_run / srun_script sont toujours relancés)
+DEDUP_JOB_TYPES = {"podman_build", "huggingface_check", "slurm_queue", "gpu_info"}
+
+# Backoff du polling : démarre à 50 ms, plafonné à 2 s
+POLL_INITIAL_INTERVAL = 0.05
+POLL_BACKOFF_FACTOR = 1.5
+POLL_MAX_INTERVAL = 2.0
+
+
+async def submit_job_async(job_type: str, **params) -> str:
     """Soumet un job dans la queue Redis et attend le résultat"""
     job_id = str(uuid.uuid4())
+    submit_time = time.monotonic()
+    
+    # Timeout adaptatif selon le type de job
+    timeout = {
+        "podman_build": 600,      # 10 min
+        "podman_run": 3600,       # 1h
+        "huggingface_check": 30,  # 30s
+        "gpu_info": 60,           # 1 min
+        "slurm_queue": 30,        # 30s
+    }.get(job_type, 300)
     
     job = {
         "id": job_id,
@@ -34,32 +103,112 @@ def submit_job(job_type: str, **params) -> str:
         **params
     }
     
-    # Envoie dans la queue
-    get_redis().lpush(QUEUE_NAME, json.dumps(job))
-    print(f"📤 Job {job_id[:8]} submitted (type: {job_type})")
+    # Un job identique est déjà en cours : on attend son résultat
+    if job_type in DEDUP_JOB_TYPES:
+        payload_hash = hashlib.sha1(
+            orjson.dumps({"t": job_type, **params}, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+        inflight_key = f"{INFLIGHT_PREFIX}{payload_hash}"
+        
+        for _ in range(INFLIGHT_CLAIM_ATTEMPTS):
+            if await get_redis().set(inflight_key, job_id, nx=True, ex=INFLIGHT_TTL):
+                # Le verrou est à nous : le worker le libérera après le résultat
+                job["inflight_key"] = inflight_key
+                break
+            existing_id = await get_redis().get(inflight_key)
+            if existing_id:
+                logger.info(f"🔁 Job {existing_id[:8]} already running (type: {job_type}), waiting on it")
+                return await wait_for_result_async(existing_id, timeout, submit_time)
+            # Verrou expiré entre le SET NX et le GET : on retente de le prendre
     
-    # Attend le résultat (avec timeout adaptatif)
-    timeout = {
-        "podman_build": 600,      # 10 min
-        "podman_run": 3600,       # 1h
-        "huggingface_check": 30,  # 30s
-        "gpu_info": 60,           # 1 min
-        "slurm_queue": 30,        # 30s
-    }.get(job_type, 300)
+    # Envoie dans la queue (LPUSH + EXPIRE en un seul aller-retour REST)
+    queue_name = HEAVY_QUEUE_NAME if job_type in HEAVY_JOB_TYPES else QUEUE_NAME
+    p = get_redis().pipeline()
+    p.lpush(queue_name, orjson.dumps(job).decode())
+    p.expire(queue_name, QUEUE_TTL)
+    try:
+        await p.exec()
+    except Exception:
+        # Job jamais mis en queue : on rend le verrou au lieu de bloquer les
+        # doublons jusqu'à son expiration
+        if job.get("inflight_key"):
+            try:
+                await get_redis().eval(_RELEASE_INFLIGHT_LUA,
+                                       keys=[job["inflight_key"]], args=[job_id])
+            except Exception as e:
+                logger.warning(f"Could not release {job['inflight_key']}: {e}")
+        raise
+    logger.info(f"📤 Job {job_id[:8]} submitted (type: {job_type})")
     
-    result = wait_for_result(job_id, timeout)
+    result = await wait_for_result_async(job_id, timeout, submit_time)
     return result
 
 
-def wait_for_result(job_id: str, timeout: int) -> str:
-    """Poll Redis pour récupérer le résultat"""
+def submit_job(job_type: str, **params) -> str:
+    """Version synchrone de submit_job_async, pour les scripts hors event loop"""
+    return _run_sync(submit_job_async(job_type, **params))
+
+
+def decode_result(value: str) -> dict:
+    """Décode un résultat écrit par le worker (JSON brut ou "zstd:" + base64)"""
+    if value.startswith("zstd:"):
+        blob = base64.b64decode(value[len("zstd:"):])
+        value = zstd.ZstdDecompressor().decompress(blob)
+    return orjson.loads(value)
+
+
+async def wait_for_result_async(job_id: str, timeout: int, submit_time: float = None) -> str:
+    """
+    Poll Redis pour récupérer le résultat, avec backoff exponentiel.
+
+    L'API REST d'Upstash ne supporte pas SUBSCRIBE : le worker publie bien
+    sur hpc:done:{job_id}, mais côté client on poll en commençant à 50 ms
+    (les jobs courts reviennent en ~50-200 ms) jusqu'à 2 s pour les longs.
+    On attend avant le premier GET : juste après le LPUSH il serait
+    forcément vide et coûterait un aller-retour pour rien.
+
+    Chaque poll lit aussi la dernière ligne de hpc:log:{job_id} (XREVRANGE
+    COUNT 1, même pipeline) pour l'afficher avec la progression des jobs longs.
+    """
     result_key = f"{RESULTS_PREFIX}{job_id}"
+    log_key = f"{LOG_PREFIX}{job_id}"
+    last_line = ""
+    if submit_time is None:
+        submit_time = time.monotonic()
+    deadline = submit_time + timeout
+    next_feedback = 10
+    interval = POLL_INITIAL_INTERVAL
     
-    for i in range(timeout):
-        result_json = get_redis().get(result_key)
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        
+        # Feedback toutes les 10s
+        elapsed = now - submit_time
+        if elapsed >= next_feedback:
+            logger.info(f"⏳ Still waiting for job {job_id[:8]}... ({int(elapsed)}s elapsed)")
+            if last_line:
+                logger.info(f"   └ {last_line}")
+            next_feedback += 10
+        
+        await asyncio.sleep(min(interval, deadline - now))
+        interval = min(interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+        
+        p = get_redis().pipeline()
+        p.get(result_key)
+        p.xrevrange(log_key, count=1)
+        result_json, last_entries = await p.exec()
+        
+        for _, fields in last_entries or []:
+            entry = dict(zip(fields[::2], fields[1::2]))
+            # "l" : ligne de stdout, "e" : ligne de stderr
+            line = entry.get("l") or entry.get("e") or ""
+            if line.strip():
+                last_line = line.rstrip()
         
         if result_json:
-            result = json.loads(result_json)
+            result = decode_result(result_json)
             
             if result.get("status") == "success":
                 return result.get("output", "")
@@ -67,20 +216,19 @@ def wait_for_result(job_id: str, timeout: int) -> str:
                 error = result.get("error", "Unknown error")
                 stderr = result.get("stderr", "")
                 return f"❌ Job failed:\n{error}\n\nStderr:\n{stderr}"
-        
-        # Feedback toutes les 10s
-        if i % 10 == 0 and i > 0:
-            print(f"⏳ Still waiting for job {job_id[:8]}... ({i}s elapsed)")
-        
-        time.sleep(1)
     
     return f"⏱️ Timeout: Job {job_id} took longer than {timeout}s"
 
 
+def wait_for_result(job_id: str, timeout: int, submit_time: float = None) -> str:
+    """Version synchrone de wait_for_result_async, pour les scripts hors event loop"""
+    return _run_sync(wait_for_result_async(job_id, timeout, submit_time))
+
+
 # ==================== TOOLS ====================
 
 @mcp.tool()
-def echo_env() -> str:
+async def echo_env() -> str:
     """Debug: vérifie les variables d'environnement et la connexion Redis."""
     url = os.getenv("UPSTASH_REDIS_REST_URL", "NOT SET")
     token = os.getenv("UPSTASH_REDIS_REST_TOKEN", "NOT SET")
@@ -90,8 +238,8 @@ def echo_env() -> str:
     
     try:
         r = get_redis()
-        r.set("ping_test", "ok", ex=10)
-        val = r.get("ping_test")
+        await r.set("ping_test", "ok", ex=10)
+        val = await r.get("ping_test")
         result += f"Redis connection: ✅ OK (ping={val})\n"
     except Exception as e:
         result += f"Redis connection: ❌ {e}\n"
@@ -99,7 +247,7 @@ def echo_env() -> str:
     return result
 
 @mcp.tool()
-def build_and_test_image(repo_url: str, dockerfile_content: str, tag: str) -> str:
+async def build_and_test_image(repo_url: str, dockerfile_content: str, tag: str) -> str:
     """
     Clone un repo, écrit un Dockerfile, build l'image avec Buildah (rootless)
     et tente un dry-run pour vérifier les dépendances.
@@ -112,7 +260,7 @@ def build_and_test_image(repo_url: str, dockerfile_content: str, tag: str) -> st
     Returns:
         Build logs et résultat du dry-run
     """
-    return submit_job(
+    return await submit_job_async(
         "podman_build",
         repo_url=repo_url,
         dockerfile_content=dockerfile_content,
@@ -121,7 +269,7 @@ def build_and_test_image(repo_url: str, dockerfile_content: str, tag: str) -> st
 
 
 @mcp.tool()
-def run_benchmark_in_container(image_tag: str, command: str, gpus: int = 1) -> str:
+async def run_benchmark_in_container(image_tag: str, command: str, gpus: int = 1) -> str:
     """
     Lance une commande dans un container avec accès GPU.
     
@@ -133,7 +281,7 @@ def run_benchmark_in_container(image_tag: str, command: str, gpus: int = 1) -> s
     Returns:
         Stdout de la commande
     """
-    return submit_job(
+    return await submit_job_async(
         "podman_run",
         image_tag=image_tag,
         command=command,
@@ -142,7 +290,7 @@ def run_benchmark_in_container(image_tag: str, command: str, gpus: int = 1) -> s
 
 
 @mcp.tool()
-def run_script_on_hpc(script: str, partition: str = "dev", cpus: int = 8, 
+async def run_script_on_hpc(script: str, partition: str = "dev", cpus: int = 8, 
                       mem: str = "64G", gpus: int = 1) -> str:
     """
     Exécute un script bash arbitraire sur le HPC via srun.
@@ -157,7 +305,7 @@ def run_script_on_hpc(script: str, partition: str = "dev", cpus: int = 8,
     Returns:
         Output du script
     """
-    return submit_job(
+    return await submit_job_async(
         "srun_script",
         script=script,
         partition=partition,
@@ -168,7 +316,7 @@ def run_script_on_hpc(script: str, partition: str = "dev", cpus: int = 8,
 
 
 @mcp.tool()
-def check_huggingface_model(model_id: str) -> str:
+async def check_huggingface_model(model_id: str) -> str:
     """
     Interroge l'API HuggingFace pour récupérer les infos d'un modèle.
     
@@ -178,32 +326,32 @@ def check_huggingface_model(model_id: str) -> str:
     Returns:
         Infos JSON du modèle (taille, safetensors, etc.)
     """
-    return submit_job(
+    return await submit_job_async(
         "huggingface_check",
         model_id=model_id
     )
 
 
 @mcp.tool()
-def check_slurm_queue() -> str:
+async def check_slurm_queue() -> str:
     """
     Affiche l'état de la queue SLURM (squeue).
     
     Returns:
         Output de squeue formaté
     """
-    return submit_job("slurm_queue")
+    return await submit_job_async("slurm_queue")
 
 
 @mcp.tool()
-def get_gpu_info() -> str:
+async def get_gpu_info() -> str:
     """
     Récupère les infos des GPUs disponibles (nvidia-smi).
     
     Returns:
         Output de nvidia-smi
     """
-    return submit_job("gpu_info")
+    return await submit_job_async("gpu_info")
 
 
 if __name__ == "__main__":
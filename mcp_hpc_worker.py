@@ -1,56 +1,316 @@
 # mcp_hpc_worker.py
 import os
 import sys
-import json
+import argparse
+import logging
+import logging.handlers
 import time
+import base64
+import hashlib
+import queue
 import subprocess
+import threading
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import orjson
+import urllib3
+from urllib3.util.retry import Retry
+import zstandard as zstd
 from upstash_redis import Redis
-from datetime import datetime
+from datetime import datetime, timezone
+
+logger = logging.getLogger("hpc")
+
+# Verrou de déduplication (cf. submit_job côté client) : on ne touche au
+# verrou que s'il appartient encore à ce job, il a pu expirer et être repris
+_REFRESH_INFLIGHT_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_INFLIGHT_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Pool HTTPS keep-alive partagé pour l'API HuggingFace (évite un handshake TLS par check)
+# Le timeout vaut par tentative : 3 tentatives x 5 s + backoff ≈ 16 s au pire,
+# sous les 30 s d'attente du client pour huggingface_check.
+_HF_TIMEOUT = urllib3.Timeout(connect=2.0, read=4.0, total=5.0)
+_hf_pool = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=8,
+    timeout=_HF_TIMEOUT,
+    retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                  raise_on_status=False),
+    headers={"User-Agent": "hpc-mcp/1.0"},
+)
+
+# Un seul client Redis par process : upstash_redis garde un pool httpx
+# keep-alive, partagé par tous les workers et threads du process.
+_redis_client = None
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = Redis.from_env()
+    return _redis_client
+
 
 class HPCWorker:
-    def __init__(self, worker_id="worker-1"):
+    # Jobs qui monopolisent GPU / disque : queue dédiée, limités par self._heavy_slots
+    HEAVY_JOB_TYPES = {"podman_build", "podman_run", "srun_script"}
+
+    def __init__(self, worker_id="worker-1", max_concurrent=8, max_heavy=1, redis=None):
         self.worker_id = worker_id
-        self.redis = Redis.from_env()
+        self.redis = redis if redis is not None else get_redis()
         self.queue_name = "hpc:jobs"
+        self.heavy_queue_name = "hpc:jobs:heavy"
         self.results_prefix = "hpc:result:"
-
-        print(f"🚀 Worker {worker_id} started")
-        print(f"📡 Connected to Upstash Redis")
-        sys.stdout.flush()
+        self.done_channel_prefix = "hpc:done:"
+        self.audit_key = "hpc:audit"
+        self.audit_max_len = 1000
+
+        # Verrou de déduplication : TTL court, prolongé tant que le job tourne
+        self.inflight_ttl = 60
+        self.inflight_refresh_interval = 20
+
+        # Cache des réponses de l'API HuggingFace (préfixe hf:* pour flush sélectif)
+        self.hf_cache_prefix = "hf:model:"
+        self.hf_cache_ttl = 3600
+        self.hf_cache_ttl_stale = 86400      # modèles non modifiés depuis 30 jours
+        self.hf_stale_after_days = 30
+
+        # ID des images déjà buildées, indexés par sha256(repo_url + Dockerfile)
+        self.image_cache_key = "hpc:image:cache"
+        self.image_ttl_prefix = "hpc:image:ttl:"
+        self.image_cache_ttl = 14 * 86400
+
+        # Résultats plus gros que ça : compressés en zstd avant le SET
+        # (logs de build/training, limite de 10 Mo par requête Upstash)
+        self.compress_threshold = 64 * 1024
+
+        # Stdout / stderr des jobs longs streamés ligne par ligne dans hpc:log:{job_id}
+        self.log_prefix = "hpc:log:"
+        self.log_maxlen = 100000
+        self.log_flush_lines = 50
+        self.log_flush_interval = 0.2
+        # Seule la fin de stdout / stderr est gardée en mémoire pour le résultat final
+        self.max_output_chars = 16 * 1024 * 1024
+
+        # Mounts GPU calculés une fois au démarrage (cf. _detect_gpu_mounts)
+        self._gpu_mounts_cache = None
+        self._gpu_mounts_mtime = None
+        self._detect_gpu_mounts()
+
+        # Backoff du polling quand la queue est vide (l'API REST n'a pas BRPOP)
+        self.idle_min_sleep = 0.1
+        self.idle_max_sleep = 5.0
+
+        # Les handlers passent leur temps dans des subprocess / appels réseau,
+        # des threads suffisent pour les exécuter en parallèle.
+        self.max_concurrent = max_concurrent
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent,
+                                        thread_name_prefix=worker_id)
+        self._heavy_slots = threading.BoundedSemaphore(max_heavy)
+        self._inflight = set()
+        self._heavy_turn = False
+        self._stop = threading.Event()
+
+        logger.info(f"🚀 Worker {worker_id} started")
+        logger.info("📡 Connected to Upstash Redis")
 
     def run(self):
-        """Boucle principale — 100% synchrone, pas d'asyncio"""
-        while True:
+        """
+        Boucle principale — synchrone, pas d'asyncio.
+
+        Dépile d'un coup autant de jobs légers que de slots libres (RPOP
+        count, atomique côté Redis) et les exécute dans le pool de threads.
+        Un job lourd n'est dépilé que si un slot lourd est libre : les autres
+        restent dans hpc:jobs:heavy pour les workers inoccupés. Avec un seul
+        slot libre, les deux queues sont servies à tour de rôle.
+        """
+        idle_sleep = self.idle_min_sleep
+        missed_turn = False
+        while not self._stop.is_set():
+            heavy_reserved = False
             try:
-                job_json = self.redis.rpop(self.queue_name)
+                self._inflight = {f for f in self._inflight if not f.done()}
+                free_slots = self.max_concurrent - len(self._inflight)
+                if free_slots <= 0:
+                    wait(self._inflight, return_when=FIRST_COMPLETED)
+                    continue
+
+                # Un seul slot : on alterne, sinon un job lourd le prendrait à chaque tour
+                heavy_turn = free_slots > 1 or self._heavy_turn
+                if free_slots == 1:
+                    self._heavy_turn = not self._heavy_turn
+                heavy_reserved = heavy_turn and self._heavy_slots.acquire(blocking=False)
+                light_slots = free_slots - 1 if heavy_reserved else free_slots
+                skipped_queue = free_slots == 1 and (heavy_reserved or not heavy_turn)
+
+                p = self.redis.pipeline()
+                if heavy_reserved:
+                    p.rpop(self.heavy_queue_name)
+                if light_slots > 0:
+                    p.rpop(self.queue_name, light_slots)
+                popped = p.exec()
+
+                heavy_json = popped.pop(0) if heavy_reserved else None
+                job_jsons = popped[0] if popped else None
+
+                pending = [(job_json, False) for job_json in job_jsons or []]
+                if heavy_json:
+                    pending.insert(0, (heavy_json, True))
+                elif heavy_reserved:
+                    self._heavy_slots.release()
+                # Le slot lourd réservé appartient désormais à _submit
+                heavy_reserved = False
+                self._submit_all(pending)
+
+                if pending:
+                    idle_sleep = self.idle_min_sleep
+                    missed_turn = False
+                elif skipped_queue and not missed_turn:
+                    # L'autre queue n'a pas été consultée : on la tente avant de dormir
+                    missed_turn = True
+                else:
+                    missed_turn = False
+                    logger.debug("💤 Idle")
+                    # Un job qui se termine libère peut-être un slot lourd : on repoll aussitôt
+                    if self._inflight:
+                        wait(self._inflight, timeout=idle_sleep, return_when=FIRST_COMPLETED)
+                    else:
+                        self._stop.wait(idle_sleep)
+                    idle_sleep = min(idle_sleep * 2, self.idle_max_sleep)
 
-                if job_json:
-                    job = json.loads(job_json)
-                    print(f"\n📥 Job {job['id'][:8]}: {job['type']}")
-                    sys.stdout.flush()
+            except Exception as e:
+                if heavy_reserved:
+                    self._heavy_slots.release()
+                logger.error(f"❌ Error in main loop: {e}")
+                self._stop.wait(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, self.idle_max_sleep)
 
-                    result = self.execute_job(job)
+    def stop(self):
+        """Demande l'arrêt de la boucle principale ; les jobs en cours se terminent"""
+        self._stop.set()
 
-                    result_key = f"{self.results_prefix}{job['id']}"
-                    self.redis.set(result_key, json.dumps(result), ex=3600)
+    def _submit_all(self, pending):
+        """
+        Lance les jobs dépilés (liste de (job_json, heavy), du plus ancien au
+        plus récent). Si l'un échoue, celui-ci et les suivants sont remis en
+        queue avant de propager l'erreur : rien n'est perdu.
+        """
+        for i, (job_json, heavy) in enumerate(pending):
+            try:
+                self._submit(job_json, heavy=heavy)
+            except Exception:
+                self._requeue(pending[i:])
+                raise
 
-                    status = "✅" if result['status'] == 'success' else "❌"
-                    print(f"{status} Job {job['id'][:8]} done ({result.get('duration', 0)}s)")
-                    sys.stdout.flush()
+    def _requeue(self, entries):
+        """Remet des jobs non lancés en fin de queue, dans leur ordre d'origine"""
+        try:
+            p = self.redis.pipeline()
+            # RPOP lit la fin de liste : le plus ancien doit être poussé en dernier
+            for job_json, heavy in reversed(entries):
+                p.rpush(self.heavy_queue_name if heavy else self.queue_name, job_json)
+            p.exec()
+        except Exception as e:
+            logger.error(f"❌ Lost {len(entries)} popped job(s), requeue failed: {e}")
+            for job_json, _ in entries:
+                logger.error(f"   lost job: {job_json}")
 
-                else:
-                    print("💤 Idle...", end='\r')
-                    sys.stdout.flush()
-                    time.sleep(5)
+    def _submit(self, job_json, heavy=False):
+        """Lance un job dépilé dans le pool ; heavy=True : il détient un slot lourd"""
+        try:
+            job = orjson.loads(job_json)
+        except ValueError as e:
+            if heavy:
+                self._heavy_slots.release()
+            logger.error(f"❌ Dropping malformed job: {e}")
+            return
+
+        if not heavy and job.get('type') in self.HEAVY_JOB_TYPES:
+            # Job lourd arrivé sur la queue légère (ancien client) : on le remet
+            # en tête de la queue lourde au lieu d'occuper un slot à l'attendre
+            self.redis.rpush(self.heavy_queue_name, job_json)
+            return
+
+        try:
+            self._inflight.add(self._pool.submit(self.process_job, job, heavy))
+        except Exception:
+            if heavy:
+                self._heavy_slots.release()
+            raise
 
+    def process_job(self, job, heavy=False):
+        """Exécute un job et publie son résultat (appelé dans le pool)"""
+        logger.info(f"📥 Job {job['id'][:8]}: {job['type']}")
+
+        stop_refresh = threading.Event()
+        if job.get('inflight_key'):
+            threading.Thread(target=self._keep_inflight, args=(job, stop_refresh),
+                             daemon=True).start()
+
+        try:
+            result = self.execute_job(job)
+        finally:
+            stop_refresh.set()
+            if heavy:
+                self._heavy_slots.release()
+
+        try:
+            self.publish_result(job, result)
+        except Exception as e:
+            logger.error(f"❌ Could not publish result of job {job['id'][:8]}: {e}")
+            return
+
+        status = "✅" if result['status'] == 'success' else "❌"
+        logger.info(f"{status} Job {job['id'][:8]} done ({result.get('duration_ms', 0) / 1000:.2f}s)")
+
+    def _keep_inflight(self, job, stop):
+        """Prolonge le verrou de déduplication du job jusqu'à ce que `stop` soit posé"""
+        while True:
+            try:
+                self.redis.eval(_REFRESH_INFLIGHT_LUA, keys=[job['inflight_key']],
+                                args=[job['id'], str(self.inflight_ttl)])
             except Exception as e:
-                print(f"❌ Error in main loop: {e}")
-                sys.stdout.flush()
-                time.sleep(5)
+                logger.warning(f"Could not refresh dedup lock of job {job['id'][:8]}: {e}")
+            if stop.wait(self.inflight_refresh_interval):
+                return
+
+    def publish_result(self, job, result):
+        """Écrit le résultat, notifie et journalise en un seul aller-retour REST"""
+        audit = {
+            "id":          job['id'],
+            "type":        job['type'],
+            "status":      result['status'],
+            "duration_ms": result.get('duration_ms', 0),
+            "worker_id":   self.worker_id,
+            "timestamp":   time.time(),
+        }
+
+        p = self.redis.pipeline()
+        p.set(f"{self.results_prefix}{job['id']}", self._encode_result(result), ex=3600)
+        p.publish(f"{self.done_channel_prefix}{job['id']}", "1")
+        p.lpush(self.audit_key, orjson.dumps(audit).decode())
+        p.ltrim(self.audit_key, 0, self.audit_max_len - 1)
+        # Sentinelle de fin, seulement si le job a streamé des logs
+        p.xadd(f"{self.log_prefix}{job['id']}", "*", {"status": result['status']},
+               nomkstream=True)
+        # Libère la déduplication côté client (cf. submit_job)
+        if job.get('inflight_key'):
+            p.eval(_RELEASE_INFLIGHT_LUA, keys=[job['inflight_key']], args=[job['id']])
+        p.exec()
 
     def execute_job(self, job):
         """Route vers le bon handler"""
-        start = time.time()
+        start = time.monotonic_ns()
 
         handlers = {
             "podman_build":       self.handle_podman_build,
@@ -70,14 +330,14 @@ class HPCWorker:
 
         try:
             result = handler(job)
-            result['duration'] = round(time.time() - start, 2)
+            result['duration_ms'] = (time.monotonic_ns() - start) // 1_000_000
             result['worker_id'] = self.worker_id
             return result
         except Exception as e:
             return {
                 "status": "failed",
                 "error": str(e),
-                "duration": round(time.time() - start, 2)
+                "duration_ms": (time.monotonic_ns() - start) // 1_000_000
             }
 
     # ==================== HANDLERS ====================
@@ -87,6 +347,15 @@ class HPCWorker:
         dockerfile  = job['dockerfile_content']
         tag         = job['tag']
         work_dir    = f"/tmp/build_{job['id'][:8]}"
+        build_hash  = hashlib.sha256((repo_url + dockerfile).encode()).hexdigest()
+
+        # Le tag a pu être réutilisé par un autre build depuis : on (re)tague
+        # toujours à partir de l'ID d'image, qui lui est immuable
+        cached_id = self._cached_image(build_hash)
+        if cached_id:
+            retag = self._run_argv(["buildah", "tag", cached_id, tag])
+            if retag['status'] == 'success':
+                return {"status": "success", "output": f"cached:{tag} ({cached_id})"}
 
         script = f"""#!/bin/bash
 set -e
@@ -105,31 +374,50 @@ buildah run --isolation chroot test-{job['id'][:8]} python3 --version 2>&1 || ec
 buildah rm test-{job['id'][:8]} 2>/dev/null || true
 echo "✅ Build complete: {tag}"
 """
-        return self._run_bash(script)
+        result = self._run_bash(script, job['id'])
+
+        if result['status'] == 'success':
+            image_id = self._image_id(tag)
+            if image_id:
+                # Best-effort : un cache indisponible ne doit pas faire échouer le build
+                try:
+                    p = self.redis.pipeline()
+                    p.hset(self.image_cache_key, build_hash, image_id)
+                    p.set(f"{self.image_ttl_prefix}{build_hash}", "1", ex=self.image_cache_ttl)
+                    p.exec()
+                except Exception as e:
+                    logger.warning(f"Could not cache image {image_id} for {tag}: {e}")
+
+        return result
 
     def handle_podman_run(self, job):
         image_tag = job['image_tag']
         command   = job['command']
         gpus      = job.get('gpus', 1)
 
-        gpu_mounts = self._detect_gpu_mounts() if gpus > 0 else ""
-
-        script = f"""#!/bin/bash
-set -e
-echo "Running in container: {image_tag}"
-echo "Command: {command}"
-
-ctr=$(buildah from {image_tag})
+        gpu_mounts = self._detect_gpu_mounts() if gpus > 0 else []
+        header = f"Running in container: {image_tag}\nCommand: {command}\n"
 
-# Execute /bin/bash inside the container and feed it the command via standard input.
-# This bypasses the $PATH issue and safely handles any messy quotes in the command string.
-buildah run --isolation chroot {gpu_mounts} $ctr -- /bin/bash << 'EOF_CMD'
-{command}
-EOF_CMD
+        # argv sans shell : image_tag / mounts ne passent jamais par bash
+        created = self._run_argv(["buildah", "from", image_tag])
+        if created['status'] != 'success':
+            created['output'] = header + created['output']
+            return created
+        ctr = created['output'].strip().splitlines()[-1]
 
-buildah rm $ctr
-"""
-        return self._run_bash(script)
+        try:
+            # Execute /bin/bash inside the container and feed it the command via standard input.
+            # This bypasses the $PATH issue and safely handles any messy quotes in the command string.
+            result = self._run_argv(
+                ["buildah", "run", "--isolation", "chroot", *gpu_mounts, ctr, "--", "/bin/bash"],
+                job['id'],
+                stdin_data=command
+            )
+        finally:
+            self._run_argv(["buildah", "rm", ctr])
+
+        result['output'] = header + result['output']
+        return result
 
     def handle_srun_script(self, job):
         # The worker already runs inside a SLURM-allocated container (via Pyxis/Enroot).
@@ -139,22 +427,109 @@ buildah rm $ctr
         wrapped = f"""#!/bin/bash
 {script}
 """
-        return self._run_bash(wrapped)
+        return self._run_bash(wrapped, job['id'])
 
     def handle_huggingface_check(self, job):
+        # Appel HTTP direct : plus de `curl | python3 -m json.tool` (2 fork+exec)
         model_id = job['model_id']
-        script = f'curl -s "https://huggingface.co/api/models/{model_id}" | python3 -m json.tool'
-        return self._run_bash(script)
+        cache_key = f"{self.hf_cache_prefix}{model_id}"
+
+        # Cache-aside best-effort : Redis indisponible = on interroge l'API
+        try:
+            cached = self.redis.get(cache_key)
+        except Exception as e:
+            logger.warning(f"Could not read HF cache for {model_id}: {e}")
+            cached = None
+        if cached:
+            return {"status": "success", "output": cached, "cached": True}
+
+        url = f"https://huggingface.co/api/models/{urllib.parse.quote(model_id, safe='/')}"
+        resp = _hf_pool.request("GET", url)
+        if resp.status != 200:
+            return {
+                "status": "failed",
+                "output": resp.data.decode(errors="replace"),
+                "error":  f"HuggingFace API returned HTTP {resp.status} for {model_id}"
+            }
+
+        info = orjson.loads(resp.data)
+        output = orjson.dumps(info, option=orjson.OPT_INDENT_2).decode()
+        try:
+            self.redis.set(cache_key, output, ex=self._hf_cache_ttl(info))
+        except Exception as e:
+            logger.warning(f"Could not write HF cache for {model_id}: {e}")
+
+        return {"status": "success", "output": output}
 
     def handle_slurm_queue(self, job):
-        return self._run_bash("squeue -u $USER")
+        return self._run_argv(["squeue", "-u", os.environ.get("USER", "")])
 
     def handle_gpu_info(self, job):
-        return self._run_bash("nvidia-smi")
+        return self._run_argv(["nvidia-smi"])
 
     # ==================== UTILS ====================
 
-    def _detect_gpu_mounts(self) -> str:
+    def _cached_image(self, build_hash: str):
+        """ID de l'image déjà buildée pour ce hash, si elle existe encore localement"""
+        try:
+            p = self.redis.pipeline()
+            p.hget(self.image_cache_key, build_hash)
+            p.exists(f"{self.image_ttl_prefix}{build_hash}")
+            image_id, fresh = p.exec()
+        except Exception as e:
+            logger.warning(f"Could not read image cache, building from scratch: {e}")
+            return None
+
+        if not image_id:
+            return None
+        if fresh and self._image_id(image_id) == image_id:
+            return image_id
+
+        # Marqueur expiré ou image supprimée : on retire l'entrée, sinon le hash
+        # grossit d'un champ par Dockerfile jamais rebuildé
+        try:
+            self.redis.hdel(self.image_cache_key, build_hash)
+        except Exception as e:
+            logger.warning(f"Could not prune image cache entry {build_hash[:12]}: {e}")
+        return None
+
+    def _image_id(self, ref: str):
+        """ID complet de l'image `ref` (tag ou ID), None si elle n'existe pas"""
+        images = self._run_argv(["buildah", "images", "-q", "--no-trunc", ref])
+        lines = images['output'].split() if images['status'] == 'success' else []
+        return lines[0] if lines else None
+
+    def _hf_cache_ttl(self, info) -> int:
+        """TTL du cache HF : plus long pour les modèles qui ne bougent plus"""
+        try:
+            last_modified = datetime.fromisoformat(info["lastModified"].replace("Z", "+00:00"))
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return self.hf_cache_ttl
+
+        age = datetime.now(timezone.utc) - last_modified
+        if age.days >= self.hf_stale_after_days:
+            return self.hf_cache_ttl_stale
+        return self.hf_cache_ttl
+
+    def _detect_gpu_mounts(self) -> list:
+        """
+        Mounts GPU mis en cache : ils ne changent qu'avec le driver, dont on
+        détecte la mise à jour via le mtime de nvidia-smi.
+        """
+        mtime = self._nvidia_smi_mtime()
+        if self._gpu_mounts_cache is None or mtime != self._gpu_mounts_mtime:
+            self._gpu_mounts_cache = self._scan_gpu_mounts()
+            self._gpu_mounts_mtime = mtime
+        return self._gpu_mounts_cache
+
+    @staticmethod
+    def _nvidia_smi_mtime():
+        try:
+            return os.stat("/usr/bin/nvidia-smi").st_mtime
+        except OSError:
+            return None
+
+    def _scan_gpu_mounts(self) -> list:
         """
         Auto-detect GPU device nodes and host driver libs by parsing Pyxis mounts.
         """
@@ -164,7 +539,7 @@ buildah rm $ctr
         mounts = []
 
         # 1. Mount the entire /dev so all nvidia device nodes are accessible
-        mounts.append("-v /dev:/dev")
+        mounts.append("/dev:/dev")
 
         # 2. Parse /proc/mounts to find exactly what Slurm/Pyxis injected
         try:
@@ -176,9 +551,9 @@ buildah rm $ctr
                         if len(parts) >= 2:
                             mount_point = parts[1]
                             if os.path.exists(mount_point) and not os.path.isdir(mount_point):
-                                mounts.append(f"-v {mount_point}:{mount_point}")
+                                mounts.append(f"{mount_point}:{mount_point}")
         except Exception as e:
-            print(f"Warning: Could not parse /proc/mounts: {e}")
+            logger.warning(f"Could not parse /proc/mounts: {e}")
 
         # 3. Explicitly grab essential symlinks (Pyxis sometimes mounts the raw versioned file, 
         # but PyTorch/nvidia-smi look for the .so.1 or .so symlinks)
@@ -188,34 +563,226 @@ buildah rm $ctr
         )
         for lib in extra_libs:
             if os.path.exists(lib):
-                mounts.append(f"-v {lib}:{lib}")
+                mounts.append(f"{lib}:{lib}")
 
         # 4. Ensure the nvidia-smi binary is included
         smi_path = "/usr/bin/nvidia-smi"
         if os.path.exists(smi_path):
-            mounts.append(f"-v {smi_path}:{smi_path}")
+            mounts.append(f"{smi_path}:{smi_path}")
 
-        # Remove duplicates and return as a single string
+        # Remove duplicates and return as buildah argv ("-v", "src:dst", ...)
         unique_mounts = list(dict.fromkeys(mounts))
-        return " ".join(unique_mounts)
+        return [arg for mount in unique_mounts for arg in ("-v", mount)]
 
-    def _run_bash(self, script: str):
+    def _encode_result(self, result) -> str:
+        """
+        Sérialise un résultat ; au-delà du seuil, le JSON est compressé en zstd
+        et préfixé par "zstd:" (le JSON brut commence toujours par "{").
+        """
+        payload = orjson.dumps(result)
+        if len(payload) < self.compress_threshold:
+            return payload.decode()
+
+        # ZstdCompressor n'est pas thread-safe : une instance par appel
+        blob = zstd.ZstdCompressor(level=3).compress(payload)
+        return "zstd:" + base64.b64encode(blob).decode()
+
+    def _run_bash(self, script: str, job_id: str = None):
         """Exécute un script bash de façon synchrone"""
-        result = subprocess.run(
-            ["bash", "-c", script],
-            capture_output=True,
-            text=True
-        )
+        return self._run_argv(["bash", "-c", script], job_id)
+
+    def _run_argv(self, argv: list, job_id: str = None, stdin_data: str = None):
+        """
+        Exécute directement un binaire (sans shell intermédiaire).
+        stdin_data, si fourni, est écrit sur l'entrée standard du process.
+
+        Avec un job_id, stdout et stderr sont streamés dans hpc:log:{job_id}
+        au fil de l'eau (suivi en direct côté client). Dans tous les cas seule
+        la fin de chaque sortie est gardée en mémoire (max_output_chars).
+        """
+        try:
+            proc = subprocess.Popen(
+                argv,
+                stdin=subprocess.PIPE if stdin_data is not None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                # Sortie non UTF-8 : remplacée plutôt que de faire planter la lecture
+                encoding="utf-8",
+                errors="replace"
+            )
+        except FileNotFoundError:
+            # Même code que bash pour une commande introuvable
+            return {
+                "status":     "failed",
+                "output":     "",
+                "stderr":     f"{argv[0]}: command not found\n",
+                "returncode": 127
+            }
+
+        if stdin_data is not None:
+            threading.Thread(target=self._feed_stdin, args=(proc.stdin, stdin_data),
+                             daemon=True).start()
+
+        log_key = f"{self.log_prefix}{job_id}" if job_id is not None else None
+        stdout, stderr = self._read_output(proc.stdout, proc.stderr, log_key)
+
+        returncode = proc.wait()
 
         return {
-            "status":     "success" if result.returncode == 0 else "failed",
-            "output":     result.stdout,
-            "stderr":     result.stderr,
-            "returncode": result.returncode
+            "status":     "success" if returncode == 0 else "failed",
+            "output":     stdout,
+            "stderr":     stderr,
+            "returncode": returncode
         }
 
+    @staticmethod
+    def _feed_stdin(pipe, data: str):
+        # Écrit dans un thread : un gros stdin ne doit pas bloquer la lecture de stdout
+        try:
+            pipe.write(data)
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+    def _read_output(self, stdout, stderr, log_key: str = None):
+        """
+        Lit stdout et stderr en parallèle (pas de deadlock sur un pipe plein)
+        et renvoie la fin de chacun, bornée à max_output_chars.
+
+        Avec un log_key, chaque ligne est aussi poussée dans ce stream Redis
+        (champ "l" pour stdout, "e" pour stderr), par paquets de
+        log_flush_lines lignes ou toutes les log_flush_interval s.
+        """
+        lines = queue.Queue()
+
+        def pump(field, pipe):
+            # La sentinelle part toujours, sinon la boucle ci-dessous attend à l'infini
+            try:
+                for line in pipe:
+                    lines.put((field, line))
+            finally:
+                lines.put((field, None))
+
+        for field, pipe in (("l", stdout), ("e", stderr)):
+            threading.Thread(target=pump, args=(field, pipe), daemon=True).start()
+
+        tails = {"l": _OutputTail(self.max_output_chars),
+                 "e": _OutputTail(self.max_output_chars)}
+        open_pipes = len(tails)
+        pending = []
+        last_flush = time.monotonic()
+        streaming = log_key is not None
+
+        while open_pipes:
+            timeout = max(0.0, self.log_flush_interval - (time.monotonic() - last_flush))
+            try:
+                field, line = lines.get(timeout=timeout)
+            except queue.Empty:
+                field, line = None, ""
+
+            if line is None:
+                open_pipes -= 1
+            elif line:
+                tails[field].append(line)
+                if streaming:
+                    pending.append((field, line))
+
+            if pending and (not open_pipes or len(pending) >= self.log_flush_lines
+                            or time.monotonic() - last_flush >= self.log_flush_interval):
+                try:
+                    p = self.redis.pipeline()
+                    for f, l in pending:
+                        p.xadd(log_key, "*", {f: l}, maxlen=self.log_maxlen)
+                    p.expire(log_key, 3600)
+                    p.exec()
+                except Exception as e:
+                    # Le job continue même si Redis décroche, sans streaming
+                    logger.warning(f"Could not stream logs to {log_key}: {e}")
+                    streaming = False
+                pending = []
+                last_flush = time.monotonic()
+            elif not pending:
+                last_flush = time.monotonic()
+
+        return tails["l"].text(), tails["e"].text()
+
+
+class _OutputTail:
+    """Fin d'une sortie de process, bornée à max_chars (lignes entières)"""
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.lines = deque()
+        self.chars = 0
+        self.truncated = 0
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.chars += len(line)
+        while self.chars > self.max_chars and len(self.lines) > 1:
+            dropped = self.lines.popleft()
+            self.chars -= len(dropped)
+            self.truncated += len(dropped)
+
+    def text(self) -> str:
+        output = "".join(self.lines)
+        if self.truncated:
+            output = f"[... {self.truncated} chars truncated ...]\n" + output
+        return output
+
+
+def setup_logging(level=logging.INFO):
+    """
+    Les handlers ne font que poser les records dans une queue ; le formatage
+    et les write() sur stdout se font dans le thread du QueueListener.
+    """
+    log_queue = queue.Queue(-1)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    return listener
+
+
+def positive_int(value: str) -> int:
+    """Type argparse : entier >= 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not an integer")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def default_concurrency() -> int:
+    """Nombre de CPUs réellement alloués (cpuset SLURM / cgroup), pas ceux du nœud"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
 
 if __name__ == "__main__":
-    worker_id = sys.argv[1] if len(sys.argv) > 1 else "worker-1"
-    worker = HPCWorker(worker_id)
-    worker.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="HPC worker: exécute les jobs de la queue Redis")
+    parser.add_argument("worker_id", nargs="?", default="worker-1")
+    parser.add_argument("--concurrency", type=positive_int, default=default_concurrency(),
+                        help="jobs exécutés en parallèle (défaut : CPUs alloués)")
+    parser.add_argument("--max-heavy", type=positive_int, default=1,
+                        help="jobs podman/srun exécutés en parallèle (défaut : 1)")
+    parser.add_argument("--debug", action="store_true",
+                        help="logs DEBUG (dont les polls à vide)")
+    args = parser.parse_args()
+
+    listener = setup_logging(logging.DEBUG if args.debug else logging.INFO)
+    try:
+        worker = HPCWorker(args.worker_id, max_concurrent=args.concurrency,
+                           max_heavy=args.max_heavy)
+        worker.run()
+    finally:
+        listener.stop()
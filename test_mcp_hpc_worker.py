@@ -0,0 +1,307 @@
+# test_mcp_hpc_worker.py
+import threading
+import time
+
+import orjson
+
+from mcp_hpc_worker import HPCWorker
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def exec(self):
+        self.redis.executed.extend(self.commands)
+        results = []
+        for name, args, kwargs in self.commands:
+            method = getattr(self.redis, name, None)
+            results.append(method(*args, **kwargs) if method else None)
+        self.commands = []
+        return results
+
+
+class FakeRedis:
+    """Redis minimal en mémoire : juste ce que le worker utilise"""
+    def __init__(self):
+        self.executed = []
+        self.lists = {}
+        self.hashes = {}
+        self.strings = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    def get(self, key):
+        return self.strings.get(key)
+
+    def set(self, key, value, **kwargs):
+        self.strings[key] = value
+        return True
+
+    def exists(self, key):
+        return int(key in self.strings)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        return int(self.hashes.get(key, {}).pop(field, None) is not None)
+
+    def rpop(self, key, count=None):
+        items = self.lists.get(key, [])
+        if not items:
+            return None
+        if count is None:
+            return items.pop()
+        return [items.pop() for _ in range(min(count, len(items)))]
+
+
+def make_worker():
+    return HPCWorker("test", max_concurrent=1, redis=FakeRedis())
+
+
+def run_with_timeout(fn, timeout=10):
+    result = []
+    t = threading.Thread(target=lambda: result.append(fn()), daemon=True)
+    t.start()
+    t.join(timeout)
+    assert not t.is_alive(), "command hung"
+    return result[0]
+
+
+def test_streamed_invalid_utf8_output_does_not_hang():
+    worker = make_worker()
+    result = run_with_timeout(
+        lambda: worker._run_bash("printf 'ok\\n\\xff\\xfe bad\\n'; exit 1", "job-utf8")
+    )
+    assert result["status"] == "failed"
+    assert result["output"].startswith("ok\n")
+    assert "�" in result["output"]
+
+
+def test_buffered_invalid_utf8_output_is_replaced():
+    worker = make_worker()
+    result = run_with_timeout(lambda: worker._run_bash("printf '\\xff\\n'"))
+    assert result["status"] == "success"
+    assert result["output"] == "�\n"
+
+
+def test_stderr_is_bounded_and_streamed():
+    worker = make_worker()
+    worker.max_output_chars = 100
+    result = run_with_timeout(lambda: worker._run_bash(
+        "for i in $(seq 1 50); do echo \"err line $i\" >&2; done; echo out", "job-err"
+    ))
+    assert result["output"] == "out\n"
+    assert result["stderr"].startswith("[... ")
+    assert result["stderr"].endswith("err line 50\n")
+    assert len(result["stderr"]) < 200
+
+    streamed = [args[2] for name, args, _ in worker.redis.executed
+                if name == "xadd" and args[0] == "hpc:log:job-err"]
+    assert {"e": "err line 1\n"} in streamed
+    assert {"l": "out\n"} in streamed
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+def start_worker(worker):
+    t = threading.Thread(target=worker.run, daemon=True)
+    t.start()
+    return t
+
+
+def stop_worker(worker, thread):
+    worker.stop()
+    thread.join(5)
+    assert not thread.is_alive(), "worker did not stop"
+
+
+def job_json(job_id, job_type):
+    return orjson.dumps({"id": job_id, "type": job_type}).decode()
+
+
+def test_heavy_jobs_are_not_drained_beyond_free_heavy_slots():
+    redis = FakeRedis()
+    worker = HPCWorker("test", max_concurrent=4, max_heavy=1, redis=redis)
+    release = threading.Event()
+    started = []
+    finished = []
+
+    def execute_job(job):
+        started.append(job["id"])
+        if job["type"] == "podman_run":
+            release.wait(10)
+        finished.append(job["id"])
+        return {"status": "success"}
+
+    worker.execute_job = execute_job
+    for i in range(4):
+        redis.lpush(worker.heavy_queue_name, job_json(f"heavy-{i}", "podman_run"))
+    redis.lpush(worker.queue_name, job_json("light", "gpu_info"))
+
+    thread = start_worker(worker)
+    try:
+        # Le job léger n'attend pas derrière le job lourd en cours,
+        # et les 3 autres jobs lourds restent disponibles pour d'autres workers
+        wait_until(lambda: "light" in finished and "heavy-0" in started)
+        assert finished == ["light"]
+        assert len(redis.lists[worker.heavy_queue_name]) == 3
+    finally:
+        release.set()
+        stop_worker(worker, thread)
+
+
+def test_single_slot_worker_serves_light_queue_too():
+    redis = FakeRedis()
+    worker = HPCWorker("test", max_concurrent=1, max_heavy=1, redis=redis)
+    finished = []
+
+    def execute_job(job):
+        finished.append(job["id"])
+        return {"status": "success"}
+
+    worker.execute_job = execute_job
+    for i in range(3):
+        redis.lpush(worker.heavy_queue_name, job_json(f"heavy-{i}", "podman_run"))
+    redis.lpush(worker.queue_name, job_json("light", "gpu_info"))
+
+    thread = start_worker(worker)
+    try:
+        wait_until(lambda: "light" in finished)
+        # Les deux queues sont servies à tour de rôle
+        assert finished.index("light") <= 1
+    finally:
+        stop_worker(worker, thread)
+
+
+def test_popped_jobs_are_requeued_when_submit_fails():
+    worker = make_worker()
+    redis = worker.redis
+    pending = [(job_json("heavy", "podman_run"), True)]
+    pending += [(job_json(f"job-{i}", "gpu_info"), False) for i in range(3)]
+
+    calls = []
+
+    def submit(job_json, heavy=False):
+        calls.append(job_json)
+        if len(calls) == 2:
+            raise RuntimeError("redis down")
+
+    worker._submit = submit
+    try:
+        worker._submit_all(pending)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("error not propagated")
+
+    # Le job en échec et les suivants sont remis en queue, le plus ancien en tête
+    assert [redis.rpop(worker.queue_name) for _ in range(3)] == [
+        job_json("job-0", "gpu_info"), job_json("job-1", "gpu_info"),
+        job_json("job-2", "gpu_info"),
+    ]
+    assert redis.lists.get(worker.heavy_queue_name, []) == []
+
+
+def test_build_cache_follows_image_id_not_reused_tag():
+    worker = make_worker()
+    images = {}   # tag -> image ID, comme le store local de buildah
+    built = []
+
+    def run_bash(script, job_id=None):
+        image_id = f"sha256:{len(built)}"
+        built.append(image_id)
+        images["img:v1"] = image_id
+        return {"status": "success", "output": "built", "stderr": "", "returncode": 0}
+
+    def run_argv(argv, job_id=None, stdin_data=None):
+        if argv[:2] == ["buildah", "images"]:
+            ref = argv[-1]
+            image_id = ref if ref in built else images.get(ref)
+            output = f"{image_id}\n" if image_id else ""
+            return {"status": "success", "output": output, "stderr": "", "returncode": 0}
+        if argv[:2] == ["buildah", "tag"]:
+            images[argv[3]] = argv[2]
+            return {"status": "success", "output": "", "stderr": "", "returncode": 0}
+        raise AssertionError(argv)
+
+    worker._run_bash = run_bash
+    worker._run_argv = run_argv
+
+    def build(job_id, dockerfile):
+        return worker.handle_podman_build({
+            "id": job_id, "repo_url": "https://example.com/r.git",
+            "dockerfile_content": dockerfile, "tag": "img:v1",
+        })
+
+    build("job-1", "FROM a")
+    build("job-2", "FROM b")
+    result = build("job-3", "FROM a")
+
+    # Pas de rebuild, et img:v1 pointe de nouveau sur l'image de "FROM a"
+    assert built == ["sha256:0", "sha256:1"]
+    assert result["output"].startswith("cached:")
+    assert images["img:v1"] == "sha256:0"
+
+
+def test_stale_image_cache_entries_are_pruned():
+    worker = make_worker()
+    redis = worker.redis
+    worker._run_argv = lambda argv, job_id=None, stdin_data=None: {
+        "status": "success", "output": "", "stderr": "", "returncode": 0
+    }
+
+    # Marqueur TTL expiré
+    redis.hset(worker.image_cache_key, "expired", "sha256:0")
+    # Marqueur présent mais image supprimée localement
+    redis.hset(worker.image_cache_key, "removed", "sha256:1")
+    redis.set(f"{worker.image_ttl_prefix}removed", "1")
+
+    assert worker._cached_image("expired") is None
+    assert worker._cached_image("removed") is None
+    assert redis.hashes[worker.image_cache_key] == {}
+
+
+def test_build_succeeds_when_image_cache_is_unavailable():
+    worker = make_worker()
+
+    def broken_pipeline():
+        raise ConnectionError("redis down")
+
+    worker.redis.pipeline = broken_pipeline
+    worker._run_bash = lambda script, job_id=None: {
+        "status": "success", "output": "build log", "stderr": "", "returncode": 0
+    }
+    worker._run_argv = lambda argv, job_id=None, stdin_data=None: {
+        "status": "success", "output": "sha256:0\n", "stderr": "", "returncode": 0
+    }
+
+    result = worker.handle_podman_build({
+        "id": "job-1", "repo_url": "https://example.com/r.git",
+        "dockerfile_content": "FROM a", "tag": "img:v1",
+    })
+    assert result["status"] == "success"
+    assert result["output"] == "build log"